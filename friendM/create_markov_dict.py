@@ -3,29 +3,217 @@ import configparser
 import sys
 import os
 import json
-from collections import defaultdict
+import mmap
+from itertools import chain, islice
+from multiprocessing import Pool
+
+import numpy as np
+from numba import njit
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# 複数行をまとめて解析する際の区切り。MeCabが1語の未知語として返す英字列にしている
+SENTENCE_SEPARATOR = "MARKOVSENTBREAK"
+BATCH_SIZE = 256
+
+BOS_ID = 0
+EOS_ID = 1
+INITIAL_TRIPLET_CAPACITY = 1 << 16
+
+OUTPUT_FORMATS = ("txt", "bin")
+BIN_FORMAT_VERSION = 1
+
+CONTENT_TYPE_ERROR = "JSONファイルは文字列の配列である必要があります。"
+CONTENT_ERRORS = (FileNotFoundError, json.JSONDecodeError, TypeError) + ((ijson.JSONError,) if ijson else ())
+
+# プロセスごとに1つだけ生成するTagger。fork で起動したワーカーは親のものをそのまま使う
+_TAGGER = None
 
 def parse_text_to_words(tagger, text):
     """MeCabを使って文章を単語のリストに分割する"""
-    node = tagger.parseToNode(text)
     words = []
-    while node:
-        word = node.surface
-        if word and node.posid != 0:
-            words.append(word)
-        node = node.next
+    # parseToNode でノードを1つずつ辿るより、parse の出力を一括で分割する方が速い
+    # 出力は "表層形\t素性" の行が並び、最後に "EOS" 行が付く
+    for line in tagger.parse(text).split("\n"):
+        surface, sep, _ = line.partition("\t")
+        if sep and surface:
+            words.append(surface)
     return words
 
-def create_triplets_from_words(words):
-    """単語リストからマルコフ連鎖用の3単語の組を作成する"""
-    if len(words) < 2:
-        return []
-    tokens = ["@BOS@"] + words + ["@EOS@"]
-    triplets = []
-    for i in range(len(tokens) - 2):
-        w1, w2, w3 = tokens[i], tokens[i + 1], tokens[i + 2]
-        triplets.append((w1, w2, w3))
-    return triplets
+def parse_lines_to_words(tagger, lines):
+    """複数行を1回のMeCab呼び出しで解析し、行ごとの単語リストを返す"""
+    text = f"\n{SENTENCE_SEPARATOR}\n".join(lines)
+    sentences = []
+    words = []
+    for word in parse_text_to_words(tagger, text):
+        if word == SENTENCE_SEPARATOR:
+            sentences.append(words)
+            words = []
+        else:
+            words.append(word)
+    sentences.append(words)
+    if len(sentences) != len(lines):
+        # 区切りが1語として返らなかった、または入力に含まれていた場合は1行ずつ解析し直す
+        return [parse_text_to_words(tagger, line) for line in lines]
+    return sentences
+
+def iter_content_lines(content_path):
+    """JSON配列の文字列を1つずつ返す。ijsonがあれば全体を読み込まずに逐次取り出す"""
+    if ijson is None:
+        with open(content_path, "r", encoding="utf-8") as f:
+            content_lines = json.load(f)
+        if not isinstance(content_lines, list) or not all(isinstance(item, str) for item in content_lines):
+            raise TypeError(CONTENT_TYPE_ERROR)
+        yield from content_lines
+        return
+
+    with open(content_path, "rb") as f:
+        events = ijson.parse(f)
+        first = next(events, None)
+        if first is None or first[1] != "start_array":
+            raise TypeError(CONTENT_TYPE_ERROR)
+        for prefix, event, value in events:
+            if prefix != "item":
+                continue
+            if event != "string":
+                raise TypeError(CONTENT_TYPE_ERROR)
+            yield value
+
+def iter_unique(lines):
+    """初出の行だけを返す。同じ行からは同じ3単語の組しかできないので、2回目以降は解析しない
+
+    MeCabは前後の空白を読み飛ばすため、空白を除いてから比較する。
+    """
+    seen = set()
+    for line in lines:
+        line = line.strip(" \t\n")
+        if line not in seen:
+            seen.add(line)
+            yield line
+
+def iter_batches(lines, size):
+    """イテラブルを size 件ずつのリストに区切って返す"""
+    lines = iter(lines)
+    while batch := list(islice(lines, size)):
+        yield batch
+
+def _worker_init():
+    global _TAGGER
+    if _TAGGER is None:
+        _TAGGER = MeCab.Tagger()
+
+def _worker_parse(lines):
+    return parse_lines_to_words(_TAGGER, lines)
+
+def words_to_ids(words, word_to_id, id_to_word, count=-1):
+    """単語列をIDのint32配列に変換する。未登録の単語には出現順に新しいIDを割り当てる"""
+    def to_id(word):
+        word_id = word_to_id.setdefault(word, len(id_to_word))
+        if word_id == len(id_to_word):
+            id_to_word.append(word)
+        return word_id
+    return np.fromiter(map(to_id, words), dtype=np.int32, count=count)
+
+def reserve_triplet_rows(triplets, num_triplets, num_new):
+    """三つ組バッファに num_new 行を追加できるようにする
+
+    容量が足りなければまず重複した組を取り除き、それでも空きが半分未満なら倍々に拡張する。
+    バッファと有効な行数を返す。
+    """
+    capacity = len(triplets)
+    if num_triplets + num_new <= capacity:
+        return triplets, num_triplets
+    unique_rows = np.unique(triplets[:num_triplets], axis=0)
+    num_triplets = len(unique_rows)
+    triplets[:num_triplets] = unique_rows
+    required = max(num_triplets + num_new, num_triplets * 2)
+    if required <= capacity:
+        return triplets, num_triplets
+    while capacity < required:
+        capacity *= 2
+    grown = np.empty((capacity, 3), dtype=np.int32)
+    grown[:num_triplets] = triplets[:num_triplets]
+    return grown, num_triplets
+
+@njit(cache=True)
+def create_triplets_from_ids(word_ids, sentence_lengths, out, offset):
+    """文ごとに連結した単語ID列からマルコフ連鎖用の3単語の組を作成し、out の offset 行目以降に書き込む
+
+    2単語未満の文は飛ばす。書き込んだ後の次の行位置を返す。
+    """
+    pos = 0
+    for n in sentence_lengths:
+        if n >= 2:
+            for i in range(n):
+                out[offset, 0] = BOS_ID if i == 0 else word_ids[pos + i - 1]
+                out[offset, 1] = word_ids[pos + i]
+                out[offset, 2] = EOS_ID if i == n - 1 else word_ids[pos + i + 1]
+                offset += 1
+        pos += n
+    return offset
+
+def pack_keys(id1, id2):
+    """2つのID配列からキー配列を作る。C# と完全一致するキー生成方式 (id1 << 32 | (uint)id2)"""
+    keys = id1.astype(np.int64) << 32
+    keys |= id2.view(np.uint32)
+    return keys
+
+def unpack_keys(keys):
+    """キー配列を id1, id2 の配列に戻す"""
+    return keys >> 32, keys & 0xFFFFFFFF
+
+def write_intdict_txt(path, start_word_ids, group_keys, group_starts, group_lengths, all_candidates):
+    """整数辞書をテキスト形式で書き出す。全行を組み立ててから1回で書き込む"""
+    # 1行目: 開始単語IDリスト
+    lines = [",".join(map(str, start_word_ids.tolist()))]
+
+    # 2行目以降: キー情報 (id1,id2|start,length)
+    key_id1, key_id2 = unpack_keys(group_keys)
+    lines.extend(
+        f"{id1},{id2}|{start_idx},{length}"
+        for id1, id2, start_idx, length in zip(
+            key_id1.tolist(),
+            key_id2.tolist(),
+            group_starts.tolist(),
+            group_lengths.tolist(),
+        )
+    )
+
+    # 最終行: 全候補配列
+    lines.append(",".join(map(str, all_candidates.tolist())))
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+def write_intdict_bin(path, start_word_ids, group_keys, group_starts, group_lengths, all_candidates):
+    """整数辞書をバイナリ形式で書き出す。ファイルをmmapで確保し、配列をそのまま書き込む
+
+    すべてリトルエンディアンのint32で、以下の順に並ぶ。
+    ヘッダー (バージョン, 開始単語ID数, キー数, 全候補数)
+    開始単語IDリスト
+    キー情報 (id1, id2, start, length) をキー数分
+    全候補配列
+    """
+    header = np.array([BIN_FORMAT_VERSION, len(start_word_ids), len(group_keys), len(all_candidates)], dtype="<i4")
+    key_info = np.column_stack((*unpack_keys(group_keys), group_starts, group_lengths)).astype("<i4")
+    sections = [
+        header,
+        np.ascontiguousarray(start_word_ids, dtype="<i4"),
+        np.ascontiguousarray(key_info),
+        np.ascontiguousarray(all_candidates, dtype="<i4"),
+    ]
+    size = sum(section.nbytes for section in sections)
+
+    with open(path, "w+b") as f:
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as mm:
+            offset = 0
+            for section in sections:
+                mm[offset:offset + section.nbytes] = section.tobytes()
+                offset += section.nbytes
 
 def create_config_template(config_path):
     """設定ファイルのテンプレートを生成する"""
@@ -33,7 +221,8 @@ def create_config_template(config_path):
     config["Files"] = {
         "content_path": "content.json",
         "output_wordlist_path": "ContentWordList.txt",
-        "output_intdict_path": "ContentIntDict.txt"
+        "output_intdict_path": "ContentIntDict.txt",
+        "output_format": "txt"
     }
     with open(config_path, "w", encoding="utf-8") as f:
         config.write(f)
@@ -52,89 +241,78 @@ def main():
         content_path = config.get("Files", "content_path")
         output_wordlist_path = config.get("Files", "output_wordlist_path")
         output_intdict_path = config.get("Files", "output_intdict_path")
+        output_format = config.get("Files", "output_format", fallback="txt")
     except (configparser.NoSectionError, configparser.NoOptionError) as e:
         print(f"設定ファイル '{config_path}' の読み込みエラー: {e}", file=sys.stderr)
         sys.exit(1)
+    if output_format not in OUTPUT_FORMATS:
+        print(f"設定ファイル '{config_path}' の読み込みエラー: output_format は {' / '.join(OUTPUT_FORMATS)} のいずれかを指定してください。", file=sys.stderr)
+        sys.exit(1)
 
     try:
-        tagger = MeCab.Tagger()
+        _worker_init()
     except RuntimeError as e:
         print(f"MeCabの初期化に失敗しました: {e}", file=sys.stderr)
         sys.exit(1)
 
+    print(f"'{content_path}' を読み込みながら形態素解析とマルコフデータの構築を開始します...")
+    triplets = np.empty((INITIAL_TRIPLET_CAPACITY, 3), dtype=np.int32)
+    num_triplets = 0
+    word_to_id = {"@BOS@": BOS_ID, "@EOS@": EOS_ID}
+    id_to_word = ["@BOS@", "@EOS@"]
+    batches = iter_batches(iter_unique(iter_content_lines(content_path)), BATCH_SIZE)
     try:
-        print(f"'{content_path}' を読み込んでいます...")
-        with open(content_path, "r", encoding="utf-8") as f:
-            content_lines = json.load(f)
-        if not isinstance(content_lines, list) or not all(isinstance(item, str) for item in content_lines):
-            raise TypeError("JSONファイルは文字列の配列である必要があります。")
-    except (FileNotFoundError, json.JSONDecodeError, TypeError) as e:
+        with Pool(os.cpu_count(), initializer=_worker_init) as pool:
+            for sentences in pool.imap(_worker_parse, batches):
+                sentences = [words for words in sentences if len(words) >= 2]
+                sentence_lengths = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+                word_ids = words_to_ids(chain.from_iterable(sentences), word_to_id, id_to_word, int(sentence_lengths.sum()))
+                triplets, num_triplets = reserve_triplet_rows(triplets, num_triplets, len(word_ids))
+                num_triplets = create_triplets_from_ids(word_ids, sentence_lengths, triplets, num_triplets)
+    except CONTENT_ERRORS as e:
         print(f"ファイルの読み込み中にエラー: {e}", file=sys.stderr)
         sys.exit(1)
-
-    print("形態素解析とマルコフデータの構築を開始します...")
-    all_triplets = []
-    for line in content_lines:
-        words = parse_text_to_words(tagger, line)
-        triplets = create_triplets_from_words(words)
-        all_triplets.extend(triplets)
-
-    print("ユニークな単語リストを作成中...")
-    all_words = set(["@BOS@", "@EOS@"])
-    for w1, w2, w3 in all_triplets:
-        all_words.update([w1, w2, w3])
-
-    id_to_word = sorted(list(all_words))
-    word_to_id = {word: i for i, word in enumerate(id_to_word)}
+    triplets = triplets[:num_triplets]
 
     print("整数ベースの辞書を生成中...")
-    int_markov_data = defaultdict(list)
-    start_word_ids = set()
-
-    for w1, w2, w3 in all_triplets:
-        if w1 == "@BOS@":
-            start_word_ids.add(word_to_id[w2])
-        id1, id2, id3 = word_to_id[w1], word_to_id[w2], word_to_id[w3]
+    keys = pack_keys(triplets[:, 0], triplets[:, 1])
 
-        # C# と完全一致するキー生成方式
-        long_key = (int(id1) << 32) | (int(id2) & 0xFFFFFFFF)
-        int_markov_data[long_key].append(id3)
+    # キー順、同じキーの中では候補ID順に並べる
+    order = np.lexsort((triplets[:, 2], keys))
+    sorted_keys = keys[order]
+    sorted_vals = triplets[order, 2]
 
     print("フラット配列を構築中...")
-    sorted_keys = sorted(int_markov_data.keys())
-    all_candidates = []
-    key_info = []
+    # 直前の行とキーか候補IDが異なる行だけを残すと、キーごとの重複のない候補列になる
+    is_unique = np.ones(len(sorted_keys), dtype=bool)
+    is_unique[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | (sorted_vals[1:] != sorted_vals[:-1])
+    unique_keys = sorted_keys[is_unique]
+    all_candidates = sorted_vals[is_unique]
+
+    is_group_start = np.ones(len(unique_keys), dtype=bool)
+    is_group_start[1:] = unique_keys[1:] != unique_keys[:-1]
+    group_starts = np.flatnonzero(is_group_start)
+    group_lengths = np.diff(np.append(group_starts, len(unique_keys)))
+    group_keys = unique_keys[group_starts]
 
-    for key in sorted_keys:
-        unique_candidates = sorted(set(int_markov_data[key]))
-        start_index = len(all_candidates)
-        length = len(unique_candidates)
-        all_candidates.extend(unique_candidates)
-        key_info.append((key, start_index, length))
+    # 開始単語は @BOS@ から始まるキーの2語目。キーは重複なく昇順なので、そのまま昇順で重複もない
+    # @BOS@ のキーは連続した範囲に並ぶため、範囲の両端を二分探索で求める
+    bos_start, bos_end = np.searchsorted(group_keys, [BOS_ID << 32, (BOS_ID + 1) << 32])
+    start_word_ids = unpack_keys(group_keys[bos_start:bos_end])[1]
 
     print(f"'{output_wordlist_path}' に単語リストを書き込み中...")
     with open(output_wordlist_path, "w", encoding="utf-8") as f:
         f.write("\n".join(id_to_word))
 
     print(f"'{output_intdict_path}' に辞書データを書き込み中...")
-    with open(output_intdict_path, "w", encoding="utf-8") as f:
-        # 1行目: 開始単語IDリスト
-        f.write(",".join(map(str, sorted(start_word_ids))) + "\n")
-
-        # 2行目以降: キー情報 (id1,id2|start,length)
-        for key, start_idx, length in key_info:
-            id1 = key >> 32
-            id2 = key & 0xFFFFFFFF
-            f.write(f"{id1},{id2}|{start_idx},{length}\n")
-
-        # 最終行: 全候補配列
-        f.write(",".join(map(str, all_candidates)) + "\n")
+    write_intdict = write_intdict_bin if output_format == "bin" else write_intdict_txt
+    write_intdict(output_intdict_path, start_word_ids, group_keys, group_starts, group_lengths, all_candidates)
 
     print("\n✅ 完了しました！")
     print(f"登録単語数: {len(id_to_word)}")
-    print(f"マルコフキー数: {len(sorted_keys)}")
+    print(f"マルコフキー数: {len(group_keys)}")
     print(f"全候補数: {len(all_candidates)}")
-    print(f"推定メモリ節約: 約{len(sorted_keys)*8/(1024*1024):.2f}MB")
+    print(f"推定メモリ節約: 約{len(group_keys)*8/(1024*1024):.2f}MB")
 
 if __name__ == "__main__":
     main()